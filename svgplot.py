@@ -1,15 +1,27 @@
+import functools
 import io
 import matplotlib
 import matplotlib.pyplot as plt
-import random
+import os
 import re
-import string
 import sys
-import xml.etree.ElementTree as ET
 from itertools import chain
 from matplotlib import figure, rcParams
 from pathlib import Path
 
+# lxml parses and serializes faster, but is slower per element;
+# the standard library is used as fallback.
+try:
+    from lxml import etree as ET
+    LXML = True
+except ImportError:
+    import xml.etree.ElementTree as ET
+    LXML = False
+
+# lxml parser options to match the standard library:
+# no size limit on path data, no comments
+PARSER_OPTIONS = {"huge_tree": True, "remove_comments": True}
+
 # Matplotlib SVG backend source
 # https://github.com/matplotlib/matplotlib/blob/main/lib/matplotlib/backends/backend_svg.py
 # This library is not bad, but the underlying structure of matplotlib
@@ -36,13 +48,15 @@ if sys.version_info <= (3, 9):
     Path.with_stem = with_stem
 
 
-# When will this be added to itertools
-def ilen(it): return sum(1 for _ in it)
+# " a  b c  " -> "a b c"
+def slim_whitespace(string): return " ".join(string.split())
 
 
 def make_uid(length=8):
-    alphabet = string.ascii_lowercase + string.digits
-    return "".join(random.choices(alphabet, k=length))
+    # Hex from a single call, instead of one random choice per character.
+    # Starts with a letter, since it can end up first in an id
+    data = os.urandom(1 + length // 2)
+    return "abcdef"[data[0] % 6] + data[1:].hex()[:length - 1]
 
 
 # Components
@@ -117,26 +131,37 @@ class StyleMap:
         "text-anchor": text_anchor,
     }
 
-    @staticmethod
-    def parse(string):
-        if string == "":
-            return
-        for rule in string.split(";"):
-            yield tuple(map(str.strip, rule.split(":")))
+    # "attr: value; ..." -> [("attr", "value"), ...]
+    _rule = re.compile(r"\s*([^:;]+?)\s*:\s*([^;]*?)\s*(?:;|$)")
 
     @classmethod
-    def classify(cls, style):
-        classes = []
-        for attr, value in cls._global.items():
-            class_ = cls.attributes[attr][value]
-            classes.append(class_)
+    def parse(cls, string):
+        rules = cls._rule.findall(string)
+        # The regex skips rules without ":"; fail instead of dropping them
+        if len(rules) != sum(1 for rule in string.split(";") if rule.strip()):
+            raise ValueError(f"Malformed style: {string!r}")
+        return rules
+
+    # Shared by every classify call
+    @classmethod
+    @functools.lru_cache(maxsize=None)
+    def global_classes(cls):
+        return " ".join(
+            cls.attributes[attr][value] for attr, value in cls._global.items()
+        )
 
-        for attr, value in cls.parse(style):
-            class_ = cls.attributes[attr][value]
-            classes.append(class_)
-        return " ".join(classes)
+    # matplotlib repeats the same few style strings for every element
+    @classmethod
+    @functools.lru_cache(maxsize=4096)
+    def classify(cls, style):
+        classes = " ".join(
+            cls.attributes[attr][value] for attr, value in cls.parse(style)
+        )
+        return " ".join(filter(None, (cls.global_classes(), classes)))
 
+    # The tables are constant, so this is the same on every call
     @classmethod
+    @functools.lru_cache(maxsize=None)
     def tostring(cls):
         ruleset = []
         for attr, group in cls.attributes.items():
@@ -155,33 +180,67 @@ class StyleMap:
 
 class Namespaces:
     # Wrapper class for namespaces
-    @staticmethod
-    def _namespaces(source):
-        if isinstance(source, str):
-            source = io.StringIO(source)
-        return dict(
-            node for _event, node in ET.iterparse(source, events=['start-ns'])
-        )
-
     @staticmethod
     def register_namespaces(namespaces):
+        # lxml keeps the parsed prefixes on the tree
+        if LXML:
+            return
         for prefix, uri in namespaces.items():
             ET.register_namespace(prefix, uri)
 
     @classmethod
-    def fromstring(cls, text):
-        namespaces = cls._namespaces(text)
+    def parse(cls, source, parser=None):
+        # Parse the tree and collect namespaces in the same pass
+        if LXML and parser is not None:
+            # lxml's iterparse can't take a parser; walk the tree instead.
+            # root.nsmap alone misses e.g. dc/cc/rdf in the metadata
+            root = ET.parse(source, parser).getroot()
+            namespaces = {
+                prefix or "": uri
+                for el in root.iter() for prefix, uri in el.nsmap.items()
+            }
+        else:
+            if LXML:
+                events = ET.iterparse(
+                    source, events=['start-ns'], **PARSER_OPTIONS
+                )
+            else:
+                events = ET.iterparse(source, events=['start-ns'], parser=parser)
+            namespaces = dict(node for _event, node in events)
+            root = events.root
         cls.register_namespaces(namespaces)
-        return namespaces
+        return root, namespaces
+
+    @staticmethod
+    def _file(text):
+        # File object to parse `text` from
+        if not isinstance(text, str):
+            return io.BytesIO(text)
+        if not LXML:
+            return io.StringIO(text)
+        # lxml only reads bytes from file objects. Without its
+        # declaration the document is utf-8, whatever it declared.
+        text = re.sub(r"^<\?xml[^>]*\?>", "", text)
+        return io.BytesIO(text.encode("utf-8"))
+
+    @classmethod
+    def fromstring(cls, text):
+        return cls.frompath(cls._file(text))
 
     @classmethod
     def frompath(cls, path):
-        namespaces = cls._namespaces(path)
-        cls.register_namespaces(namespaces)
+        _root, namespaces = cls.parse(path)
         return namespaces
 
 
 class SVG:
+    # deprecated in svg 2.0
+    # https://developer.mozilla.org/en-US/docs/Web/SVG/Attribute/xlink:href
+    xlink = "{http://www.w3.org/1999/xlink}"
+
+    # Attributes referring to ids
+    uid_attributes = ("id", "href", "clip-path")
+
     def __init__(self, el, namespaces=None, id=None):
         if id is None: id = make_uid()
 
@@ -189,15 +248,24 @@ class SVG:
         self.namespaces = namespaces
         self.id = id
 
+        # Formatted once; "path" -> "{http://www.w3.org/2000/svg}path"
+        ns = (namespaces or {}).get("")
+        self.svg_ns = f"{{{ns}}}" if ns else ""
+
     @classmethod
     def fromstring(cls, text, parser=None, id=None):
-        namespaces = Namespaces.fromstring(text)
-        return cls(ET.fromstring(text, parser), namespaces, id)
+        return cls.frompath(Namespaces._file(text), parser, id)
 
     @classmethod
     def frompath(cls, path, parser=None, id=None):
-        namespaces = Namespaces.frompath(path)
-        return cls(ET.parse(path, parser).getroot(), namespaces, id)
+        root, namespaces = Namespaces.parse(path, parser)
+        return cls(root, namespaces, id)
+
+    @classmethod
+    def fromfile(cls, file, parser=None, id=None):
+        # Seekable binary file, read from the start
+        file.seek(0)
+        return cls.frompath(file, parser, id)
 
     @property
     def style(self):
@@ -205,69 +273,64 @@ class SVG:
 
     def slim(self):
         for c in self.el.iter():
-            c.text = c.text.strip() if c.text is not None else None
-            c.tail = None
+            # Most text is already clean; don't rebuild it
+            t = c.text
+            if t and (t[0].isspace() or t[-1].isspace()):
+                c.text = t.strip() or None
+            # Only write when there is something to clear
+            if c.tail is not None:
+                c.tail = None
 
-        # " a  b c  " -> "a b c"
-        _slim = lambda string: re.sub(r"^\s+|\s+$|\s+(?=\s)", "", string)
         for c in self.el.iter():
-            for att in c.keys():
-                c.set(att, _slim(c.get(att)))
+            # items() is a list, so setting is safe
+            for att, value in c.items():
+                slimmed = slim_whitespace(value)
+                if slimmed != value:
+                    c.set(att, slimmed)
 
     def svg2(self):
-        # deprecated in svg 2.0
-        # https://developer.mozilla.org/en-US/docs/Web/SVG/Attribute/xlink:href
-        xlink = "{http://www.w3.org/1999/xlink}"
+        xlink = self.xlink
         N = len(xlink)
-        def _fix(el, name):
-            if name.startswith(xlink):
-                el.set(name[N:], el.attrib.pop(name))
-
         for el in self.iter():
-            for key in el.keys():
-                _fix(el, key)
+            attrib = el.attrib
+            # Collect first; attrib can't change size while iterating
+            for key in [k for k in attrib if k.startswith(xlink)]:
+                attrib[key[N:]] = attrib.pop(key)
+
+    @staticmethod
+    def insert_uid(string, ins):
+        # It inserts `ins` after the last # and before the last -
+        # insert_uid("hello-world", "what") --> "hello-what-world"
+        # insert_uid("#hey", "world") --> #world-hey
+        # insert_uid("#a-b-c", "x") --> "#a-b-x-c"
+        string = string.replace("_", "-")
+        # Whichever comes last; 0 if neither
+        i = max(string.rfind("#"), string.rfind("-")) + 1
+        return f"{string[:i]}{ins}-{string[i:]}"
 
     def uid(self):
         # Since ids are repeated in other svgs
         # we have to insert a svg-unique id
-
-        def insert(string, ins):
-            # This code is too clever (that's a bad thing)
-            # It inserts `ins` after the last # and before the last -
-            # insert("hello-world", "what") --> "hello-what-world"
-            # insert("#hey", "world") --> #world-hey
-            # insert("#a-b-c", "x") --> "#a-b-x-c"
-            string = string.replace("_", "-")
-
-            parts = []
-            prefix, sharp, string = string.rpartition("#")
-            parts.extend([prefix, sharp])
-
-            before, dash, after = string.rpartition("-")
-            parts.extend([before, dash, ins, "-", after])
-
-            return "".join(filter(None, parts))
-
-        for el in self.iter("[@id]"):
-            id_ = insert(el.get("id"), self.id)
-            el.set("id", id_)
-
-        for el in self.iter("[@href]"):
-            href = insert(el.get("href"), self.id)
-            el.set("href", href)
-
-        for el in self.iter("[@clip-path]"):
-            clip = insert(el.get("clip-path"), self.id)
-            el.set("clip-path", clip)
-
+        if LXML:
+            # Let libxml2 pick out the elements with ids to rewrite
+            condition = " or ".join(f"@{attr}" for attr in self.uid_attributes)
+            elements = self.el.xpath(f"descendant-or-self::*[{condition}]")
+        else:
+            elements = self.iter()
+
+        for el in elements:
+            attrib = el.attrib
+            for attr in self.uid_attributes:
+                value = attrib.get(attr)
+                if value is not None:
+                    attrib[attr] = self.insert_uid(value, self.id)
 
     @staticmethod
     def set_none(el, attr, value):
-        attrs = chain(el.get(attr, "").split(" "), value.split(" "))
-        attrs = sorted(set(attrs))
-        new_value = " ".join(filter(None, attrs))
-        if new_value:
-            el.set(attr, new_value)
+        # Unique, in order of appearance; class order has no meaning
+        attrs = dict.fromkeys(chain(el.get(attr, "").split(), value.split()))
+        if attrs:
+            el.set(attr, " ".join(attrs))
 
     def classify(self):
         for el in self.iter("path"):
@@ -277,59 +340,132 @@ class SVG:
             self.set_none(el, "class", StyleMap.classify(el.attrib.pop("style", "")))
 
         # If text is path
-        for el in self.iter("[@id]"):
-            if el.get("id").startswith("DejaVuSans"):
-                self.set_none(el, "class", "text")
+        if LXML:
+            glyphs = self.el.xpath(
+                "descendant-or-self::*[starts-with(@id, 'DejaVuSans')]"
+            )
+        else:
+            glyphs = (
+                el for el in self.iter("[@id]")
+                if el.get("id").startswith("DejaVuSans")
+            )
+        for el in glyphs:
+            self.set_none(el, "class", "text")
 
         # If text is text
         for el in self.iter("text"):
             self.set_none(el, "class", StyleMap.classify(el.attrib.pop("style", "")))
             self.set_none(el, "class", "text")
 
-        assert ilen(self.iter("[@style]")) == 0
+        # Stops at the first stray style
+        assert next(self.iter("[@style]"), None) is None
 
         self.style.text = StyleMap.tostring()
 
-    @classmethod
-    def _iter(cls, el, tag, namespaces):
-        yield from el.iterfind(tag, namespaces)
-        yield from chain.from_iterable(cls._iter(c, tag, namespaces) for c in el)
+    def transform(self):
+        # classify, slim, svg2 and uid in a single pass over the tree
+        xlink = self.xlink
+        N = len(xlink)
+        svg = self.svg_ns
+        text = svg + "text"
+        styled = {svg + "path", svg + "use", text}
+
+        # Looked up once; this loop runs for every element
+        classify = StyleMap.classify
+        set_none = self.set_none
+        insert_uid = self.insert_uid
+        uid_attributes = self.uid_attributes
+        uid = self.id
+        slim = slim_whitespace
 
+        for el in self.iter():
+            attrib = el.attrib
+            tag = el.tag
+            # classify
+            classes = classify(attrib.pop("style", "")) if tag in styled else ""
+            # If text is text or text is path
+            if tag == text or attrib.get("id", "").startswith("DejaVuSans"):
+                classes += " text"
+            if classes:
+                set_none(el, "class", classes)
+            # Checked here so no extra pass over the tree is needed
+            assert "style" not in attrib
+
+            # slim
+            t = el.text
+            if t and (t[0].isspace() or t[-1].isspace()):
+                el.text = t.strip() or None
+            # Only write when there is something to clear
+            if el.tail is not None:
+                el.tail = None
+
+            for key, value in el.items():
+                slimmed = slim(value)
+                # svg2
+                if key.startswith(xlink):
+                    del attrib[key]
+                    key = key[N:]
+                    value = None
+                # uid
+                if key in uid_attributes:
+                    slimmed = insert_uid(slimmed, uid)
+                # Most attributes are already slim
+                if slimmed != value:
+                    attrib[key] = slimmed
+
+        self.style.text = StyleMap.tostring()
 
     def iter(self, tag="*"):
-        yield from self._iter(self.el, tag, self.namespaces)
+        # Let the parser walk the tree, instead of recursing in python
+        if tag == "*":
+            return self.el.iter()
+        # Plain tag names are matched by the parser, without ElementPath
+        if tag.isidentifier():
+            return self.el.iter(self.svg_ns + tag)
+        # "[@id]" -> ".[@id]" and ".//*[@id]"; predicates include the root
+        if tag.startswith("["):
+            return chain(
+                self.el.iterfind(f".{tag}", self.namespaces),
+                self.el.iterfind(f".//*{tag}", self.namespaces),
+            )
+        return self.el.iterfind(f".//{tag}", self.namespaces)
+
+    def cleanup_namespaces(self):
+        # lxml keeps declarations, e.g. xlink after svg2
+        if LXML:
+            ET.cleanup_namespaces(self.el)
 
     def tostring(self):
+        self.cleanup_namespaces()
         return ET.tostring(self.el, encoding="unicode")
 
+    def write(self, path):
+        self.cleanup_namespaces()
+        # Serialized straight to utf-8, without a str of the document
+        Path(path).write_bytes(ET.tostring(self.el, encoding="utf-8"))
+
 
 # Helper classes
 def savefig(plot, path, id=None):
-    f = io.StringIO()
+    # Bytes go straight to the parser, no str in between
+    f = io.BytesIO()
     plot.savefig(f, format="svg")
-    svg = SVG.fromstring(f.getvalue(), id)
+    svg = SVG.fromfile(f, id=id)
 
-    svg.classify()
-    svg.slim()
-    svg.svg2()
-    svg.uid()
+    svg.transform()
 
-    path = Path(path)
-    path.write_text(svg.tostring(), encoding="utf-8")
+    svg.write(path)
     print("saved")
 
 
 def minify(path, id=None):
-    svg = SVG.frompath(path, id)
+    svg = SVG.frompath(path, id=id)
 
-    svg.classify()
-    svg.slim()
-    svg.svg2()
-    svg.uid()
+    svg.transform()
 
     path = Path(path)
     path = path.with_stem(path.stem + "-min")
-    path.write_text(svg.tostring(), encoding="utf-8")
+    svg.write(path)
 
 
 if __name__ == "__main__":